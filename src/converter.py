@@ -1,131 +1,401 @@
+import html
 import os
+import re
+import sys
+import tempfile
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urljoin, urlparse
 from ebooklib import epub
-from bs4 import BeautifulSoup
+import tinycss2
+from tinycss2.ast import URLToken
+from tinycss2.serializer import serialize_url
+from lxml import etree, html as lhtml
 from weasyprint import HTML, CSS
 from tqdm import tqdm
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rules added after the EPUB's own stylesheets
+_PDF_CSS = """
+/* PDF-specific pagination rules */
+@page {
+    size: A4;
+    margin: 2cm;
+}
+
+/* Ensure sections start on new page if desired */
+section.chapter {
+    page-break-before: auto;
+}
+
+/* Image handling */
+img {
+    max-width: 100%;
+    height: auto;
+    page-break-inside: avoid;
+}
+
+/* Prevent awkward breaks */
+h1, h2, h3, h4, h5, h6 {
+    page-break-after: avoid;
+}
+
+/* Ensure links are colored and underlined */
+a {
+    color: #0066cc;
+    text-decoration: underline;
+}
+"""
+
+# Stylesheet constructs that never apply to a paginated PDF. Dropping them
+# before rendering means WeasyPrint has fewer rules to match per element.
+_INTERACTIVE_PSEUDO_CLASSES = {'hover', 'focus', 'active', 'focus-within', 'focus-visible'}
+_DROPPED_AT_RULES = {'keyframes', '-webkit-keyframes', '-moz-keyframes', '-o-keyframes'}
+
+# word-break: break-all lays text out letter by letter, which is very slow
+# in WeasyPrint; it is only kept for selectors targeting these elements
+_BREAK_ALL_SELECTOR_RE = re.compile(r'(?<![\w.#:-])(?:code|pre)\b', re.IGNORECASE)
+
+# Schemes that are left untouched when rewriting links and asset paths
+_EXTERNAL_HREF = re.compile(r'^(?:https?|mailto|tel):').match
+_EXTERNAL_SRC = re.compile(r'^(?:https?|file|data):').match
+
+# Pass 1 only needs id attribute values, so it scans raw start tags instead
+# of building a tree. The tag pattern skips over quoted attribute values so
+# a '>' inside one doesn't end the tag early. It also steps over comments
+# and the text of raw-text elements, up to the end if unclosed, since lxml
+# sees no elements in either; group 1 is then the element's own start tag.
+# The attribute pattern walks a tag one attribute at a time, so an "id="
+# inside another attribute's quoted value isn't taken for one. Both ignore
+# case since text/html items reach Pass 1 as unnormalized bytes (ID="...").
+_TAG_BODY = rb'(?:[^>"\']|"[^"]*"|\'[^\']*\')*>'
+_START_TAG_RE = re.compile(
+    rb'<!--.*?(?:-->|\Z)'
+    rb'|(<(script|style|textarea|title)(?=[\s/>])' + _TAG_BODY + rb').*?(?:</\2\s*>|\Z)'
+    rb'|(<[A-Za-z]' + _TAG_BODY + rb')',
+    re.IGNORECASE | re.DOTALL,
+)
+_ATTR_RE = re.compile(rb'([^\s"\'/>=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>"\']+)))?')
+_TAG_NAME_RE = re.compile(rb'<[^\s/>]+')
+
+# Chapter prefixes become ids, fragment hrefs and CSS selectors, so they are
+# restricted to characters that need no escaping in any of them
+_PREFIX_UNSAFE_RE = re.compile(r'[^A-Za-z0-9_]')
+
+# The chapter <body> becomes its <section>, which carries the chapter
+# prefix as its id, so the body's own id is registered as an alias of it
+_BODY_TAG_RE = re.compile(rb'<body[\s/>]', re.IGNORECASE).match
+
+# Many chapters (plain prose) carry no ids at all; one C-level search over
+# the whole buffer lets those skip the per-tag scan entirely
+_HAS_ID_ATTR = re.compile(rb'\sid\s*=', re.IGNORECASE).search
+
+# Every element Pass 2 rewrites, in document order, selected in one C-level
+# query rather than walking the whole chapter tree from Python
+_CHAPTER_NODES_XPATH = etree.XPath('.//*[@id] | .//a[@href] | .//img[@src]')
+
+# Byte-level prechecks that let Pass 2 leave out parts of that query for
+# chapters without any links or images (tags and attributes can be any case)
+_HAS_HREF_ATTR = re.compile(rb'href', re.IGNORECASE).search
+_HAS_IMG_TAG = re.compile(rb'<img', re.IGNORECASE).search
+
+# One parser for every chapter. Chapters are parsed from their raw bytes so
+# libxml2 decodes them in C; the encoding is pinned to UTF-8 so a stray
+# meta charset can't override it.
+_HTML_PARSER = lhtml.HTMLParser(recover=True, encoding='utf-8', no_network=True)
+
+def _parse(content_bytes):
+    """
+    Parse a chapter's raw bytes into an lxml HTML tree.
+    lxml wraps fragments in <html><body>, which extract_body_content expects.
+    """
+    try:
+        return lhtml.document_fromstring(content_bytes, parser=_HTML_PARSER)
+    except etree.ParserError:
+        # Empty chapter - keep an empty body so it still gets a section
+        return lhtml.document_fromstring(b'<html><body></body></html>', parser=_HTML_PARSER)
+
 def is_html_content(item):
     """Check if an item is HTML content."""
     if isinstance(item, epub.EpubHtml):
         return True
-    if hasattr(item, 'media_type'):
-        if 'html' in item.media_type.lower() or 'xhtml' in item.media_type.lower():
-            return True
-    if hasattr(item, 'file_name'):
-        if item.file_name.endswith(('.html', '.xhtml', '.htm')):
-            return True
+    media_type = getattr(item, 'media_type', None)
+    # 'xhtml' media types contain 'html' too
+    if media_type and 'html' in media_type.lower():
+        return True
+    file_name = getattr(item, 'file_name', None)
+    if file_name and file_name.endswith(('.html', '.xhtml', '.htm')):
+        return True
     return False
 
-def fix_image_paths(soup, base_path, html_file_path):
+def is_css_content(item):
+    """Check if an item is a CSS stylesheet (by media type or file extension)."""
+    media_type = getattr(item, 'media_type', None)
+    if media_type and 'css' in media_type.lower():
+        return True
+    file_name = getattr(item, 'file_name', None)
+    return bool(file_name) and file_name.endswith('.css')
+
+@lru_cache(maxsize=None)
+def _norm_join(base, rel):
+    """Cached os.path.normpath(os.path.join(base, rel)) for EPUB-relative paths."""
+    return os.path.normpath(os.path.join(base, rel))
+
+@lru_cache(maxsize=None)
+def _path_basename(path):
+    """Cached os.path.basename; books link to the same few files many times."""
+    return os.path.basename(path)
+
+@lru_cache(maxsize=None)
+def _is_file(path):
+    """Cached os.path.isfile; the same images are linked from many chapters."""
+    return os.path.isfile(path)
+
+def build_file_index(root):
+    """
+    Map the lowercased absolute path of every file under root to its real
+    path. Built once per book so asset lookups during chapter processing
+    are dict hits instead of stat() calls, case-insensitive ones included.
+    """
+    file_index = {}
+    pending = [os.path.normpath(root)]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        # Keep the first of several names differing only in case
+                        file_index.setdefault(entry.path.lower(), entry.path)
+        except OSError as e:
+            logger.warning(f"Could not index {directory}: {e}")
+    return file_index
+
+def _find_file(path, file_index):
+    """
+    Return the real path of an extracted file, matching case-insensitively
+    through the file index, or None if there is no such file.
+    """
+    found = file_index.get(path.lower())
+    if found and found != path and _is_file(path):
+        # The index keeps one name per case-folded path, so make sure an
+        # exact-case file isn't being shadowed
+        return path
+    return found
+
+def fix_image_paths(images, base_path, html_file_path, file_index):
     """
     Convert all relative image paths to absolute file:// URLs.
+    images: the chapter's <img> elements
     base_path: root of extracted EPUB (e.g., /tmp/epub2pdf_xxx/EPUB)
     html_file_path: path to the current HTML file being processed
+    file_index: {lowercased path: real path} from build_file_index
     """
     # Get the directory containing the HTML file
     html_dir = os.path.dirname(html_file_path)
     
-    for img in soup.find_all('img'):
-        if img.get('src'):
-            src = img['src']
+    for img in images:
+        src = img.get('src')
+        if src:
             
             # Skip if already absolute
-            if src.startswith(('http://', 'https://', 'file://', 'data:')):
+            if _EXTERNAL_SRC(src):
                 continue
             
-            # Resolve path relative to the HTML file's location
+            # Resolve path relative to the HTML file's location,
+            # normalizing ../ references
             if src.startswith('/'):
                 # Absolute path within EPUB
-                img_path = os.path.join(base_path, src.lstrip('/'))
+                img_path = _norm_join(base_path, src.lstrip('/'))
             else:
                 # Relative path - resolve from HTML file's directory
-                img_path = os.path.join(html_dir, src)
+                img_path = _norm_join(html_dir, src)
             
-            # Normalize the path (resolve ../ references)
-            img_path = os.path.normpath(img_path)
+            # Look the file up in the index, which also matches
+            # case-insensitively
+            found_path = _find_file(img_path, file_index)
             
-            # Check if file exists
-            if os.path.exists(img_path):
-                # Convert to file:// URL
-                img['src'] = f"file://{img_path}"
-                logger.debug(f"Fixed image: {src} -> {img['src']}")
+            if found_path == img_path:
+                # Convert to file:// URL; WeasyPrint loads each URL once
+                # per render however many chapters reference it
+                img.set('src', f"file://{img_path}")
+                logger.debug(f"Fixed image: {src} -> {img_path}")
+            elif found_path:
+                img.set('src', f"file://{found_path}")
+                logger.debug(f"Fixed image (case-insensitive): {src} -> {found_path}")
             else:
-                # Try case-insensitive search
-                img_dir = os.path.dirname(img_path)
-                img_name = os.path.basename(img_path)
-                
-                if os.path.exists(img_dir):
-                    for file in os.listdir(img_dir):
-                        if file.lower() == img_name.lower():
-                            found_path = os.path.join(img_dir, file)
-                            img['src'] = f"file://{found_path}"
-                            logger.debug(f"Fixed image (case-insensitive): {src} -> {img['src']}")
-                            break
-                    else:
-                        logger.warning(f"Image not found: {img_path}")
-                else:
-                    logger.warning(f"Image directory not found: {img_dir}")
+                logger.warning(f"Image not found: {img_path}")
 
-def collect_css_files(book, base_path):
+def _make_css_url_fixer(base_path, css_file_name, file_index):
     """
-    Extract all CSS content from the EPUB and return as a single string.
+    Build a callback that maps a relative url() target in one stylesheet
+    to an absolute file:// URL, resolved through the file index. Returns
+    None for targets that should be left alone.
     """
-    css_content = []
+    css_dir = os.path.dirname(os.path.join(base_path, css_file_name))
     
-    # Iterate through all items and find CSS files
-    for item in book.get_items():
-        # Check if it's a CSS file by media type or file extension
-        is_css = False
+    def fix_css_url(url):
+        if _EXTERNAL_SRC(url):
+            return None
         
-        if hasattr(item, 'media_type') and item.media_type:
-            if 'css' in item.media_type.lower():
-                is_css = True
+        # Build absolute path
+        abs_path = _find_file(_norm_join(css_dir, url), file_index)
         
-        if hasattr(item, 'file_name') and item.file_name:
-            if item.file_name.endswith('.css'):
-                is_css = True
+        if abs_path:
+            return f"file://{abs_path}"
+        return None
+    
+    return fix_css_url
+
+def _rewrite_css_urls(tokens, fix_url):
+    """
+    Rewrite url() references in a tinycss2 component value list in place,
+    descending into blocks and functions. Both url(x) tokens and the
+    url("x") function form are handled.
+    """
+    for i, token in enumerate(tokens):
+        if token.type == 'url':
+            url = token.value
+        elif token.type == 'function' and token.lower_name == 'url':
+            args = [arg for arg in token.arguments if arg.type not in ('whitespace', 'comment')]
+            if len(args) != 1 or args[0].type != 'string':
+                continue
+            url = args[0].value
+        else:
+            if token.type == 'function':
+                _rewrite_css_urls(token.arguments, fix_url)
+            elif token.type in ('() block', '[] block', '{} block'):
+                _rewrite_css_urls(token.content, fix_url)
+            continue
         
-        if not is_css:
+        new_url = fix_url(url)
+        if new_url is not None:
+            tokens[i] = URLToken(token.source_line, token.source_column, new_url, f"url({serialize_url(new_url)})")
+
+def _is_screen_only(media_prelude):
+    """True if every query in an @media prelude targets screens only."""
+    queries = tinycss2.serialize(media_prelude).lower().split(',')
+    return all(q.split()[:1] == ['screen'] or q.split()[:2] == ['only', 'screen'] for q in queries)
+
+def _split_selector_list(prelude):
+    """
+    Split a qualified rule's prelude into its selectors' token lists on
+    top-level commas; commas inside functions like :is()/:not() or in
+    [attr="a,b"] belong to their block or string token and don't split.
+    """
+    selectors = [[]]
+    for token in prelude:
+        if token.type == 'literal' and token.value == ',':
+            selectors.append([])
+        else:
+            selectors[-1].append(token)
+    return selectors
+
+def _is_interactive_selector(tokens):
+    """True if a selector's own top-level tokens use :hover/:focus/:active."""
+    for prev, token in zip(tokens, tokens[1:]):
+        if (token.type == 'ident' and token.lower_value in _INTERACTIVE_PSEUDO_CLASSES
+                and prev.type == 'literal' and prev.value == ':'):
+            return True
+    return False
+
+def _filter_css_rules(rules):
+    """
+    Drop rules that can't affect the PDF (screen-only @media, @keyframes,
+    :hover/:focus/:active selectors) and defuse word-break: break-all.
+    Returns the serialized stylesheet.
+    """
+    out = []
+    for rule in rules:
+        if rule.type == 'at-rule':
+            keyword = rule.lower_at_keyword
+            if keyword in _DROPPED_AT_RULES:
+                continue
+            if keyword == 'media' and rule.content is not None:
+                if _is_screen_only(rule.prelude):
+                    continue
+                inner = tinycss2.parse_blocks_contents(rule.content, skip_comments=True, skip_whitespace=True)
+                out.append(f"@media{tinycss2.serialize(rule.prelude)}{{{_filter_css_rules(inner)}}}")
+                continue
+            out.append(rule.serialize())
+        
+        elif rule.type == 'qualified-rule':
+            # Keep only the selectors in the list that can match in print
+            kept = [
+                tinycss2.serialize(tokens).strip()
+                for tokens in _split_selector_list(rule.prelude)
+                if not _is_interactive_selector(tokens)
+            ]
+            if not kept:
+                continue
+            prelude = ', '.join(kept)
+            
+            content = tinycss2.serialize(rule.content)
+            if 'break-all' in content.lower() and not _BREAK_ALL_SELECTOR_RE.search(prelude):
+                declarations = []
+                for decl in tinycss2.parse_blocks_contents(rule.content, skip_comments=True, skip_whitespace=True):
+                    if (decl.type == 'declaration' and decl.lower_name == 'word-break'
+                            and tinycss2.serialize(decl.value).strip().lower() == 'break-all'):
+                        declarations.append(f"word-break: normal{' !important' if decl.important else ''}")
+                    elif decl.type != 'error':
+                        declarations.append(decl.serialize())
+                content = '; '.join(declarations)
+            
+            out.append(f"{prelude} {{{content}}}")
+    
+    return '\n'.join(out)
+
+def filter_css(content, fix_url=None):
+    """
+    Strip constructs that are useless or known to be slow in a PDF render
+    from one stylesheet, rewriting its url() references with fix_url (see
+    _make_css_url_fixer) on the same parse.
+    """
+    rules = tinycss2.parse_stylesheet(content, skip_comments=True, skip_whitespace=True)
+    if fix_url is not None:
+        for rule in rules:
+            if rule.type in ('at-rule', 'qualified-rule'):
+                _rewrite_css_urls(rule.prelude, fix_url)
+                if rule.content is not None:
+                    _rewrite_css_urls(rule.content, fix_url)
+    return _filter_css_rules(rules)
+
+def collect_css_files(book, base_path, file_index):
+    """
+    Extract all CSS content from the EPUB.
+    Returns a list of (file_name, css_text) tuples in manifest order.
+    """
+    stylesheets = []
+    
+    # Iterate through all items and find CSS files
+    for item in book.get_items():
+        if not is_css_content(item):
             continue
         
         try:
-            content = item.get_content().decode('utf-8', errors='ignore')
+            content = item.get_content().decode('utf-8', errors='replace')
             
             # Fix relative URLs in CSS (for background images, fonts, etc.)
-            import re
-            
-            def fix_css_url(match):
-                url = match.group(1).strip('\'"')
-                if url.startswith(('http://', 'https://', 'file://', 'data:')):
-                    return match.group(0)
-                
-                # Build absolute path
-                css_dir = os.path.dirname(os.path.join(base_path, item.file_name))
-                abs_path = os.path.normpath(os.path.join(css_dir, url))
-                
-                if os.path.exists(abs_path):
-                    return f"url('file://{abs_path}')"
-                return match.group(0)
+            # while filtering, from the same token stream
+            fix_css_url = _make_css_url_fixer(base_path, item.file_name, file_index)
+            content = filter_css(content, fix_css_url)
             
-            # Fix url() references in CSS
-            content = re.sub(r'url\(["\']?([^)]+?)["\']?\)', fix_css_url, content)
-            
-            css_content.append(content)
+            stylesheets.append((item.file_name, content))
             logger.info(f"Collected CSS: {item.file_name}")
             
         except Exception as e:
             logger.warning(f"Failed to process CSS {item.file_name}: {e}")
     
-    if not css_content:
+    if not stylesheets:
         logger.warning("No CSS files found in EPUB")
     
-    return '\n\n'.join(css_content)
+    return stylesheets
 
 def extract_toc_with_hierarchy(book):
     """
@@ -172,553 +442,643 @@ def extract_toc_with_hierarchy(book):
     
     return toc_entries
 
-def build_anchor_to_page_map(pdf_path, id_registry, file_to_prefix):
+def _css_ident(value):
+    """Escape a string for use as a CSS identifier (e.g. in an #id selector)."""
+    out = []
+    for i, ch in enumerate(value):
+        if ch in '-_' or (ch.isalnum() and ch.isascii()) or ord(ch) >= 0x80:
+            # Identifiers can't start with a digit or with '-' plus a digit
+            if ch.isdigit() and (i == 0 or (i == 1 and value[0] == '-')):
+                out.append(f"\\{ord(ch):x} ")
+            else:
+                out.append(ch)
+        else:
+            out.append(f"\\{ord(ch):x} ")
+    return ''.join(out)
+
+def _css_string(value):
+    """Quote a string as a CSS string literal."""
+    value = ' '.join(str(value).split())
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+def resolve_toc_target(href, id_registry, file_to_prefix):
     """
-    Parse the PDF to find which page each anchor ID appears on.
-    Returns a dict mapping anchor_id -> page_number (0-indexed).
+    Resolve a TOC href to the id it points at in the master document.
+    Returns None if the href can't be resolved.
     """
-    try:
-        from pypdf import PdfReader
-    except ImportError:
-        try:
-            from PyPDF2 import PdfReader
-        except ImportError:
-            logger.error("pypdf or PyPDF2 not installed. Cannot map anchors to pages.")
-            return {}
-    
-    logger.info("Scanning PDF pages to map anchors...")
-    reader = PdfReader(pdf_path)
-    anchor_to_page = {}
-    
-    total_pages = len(reader.pages)
-    
-    # Build a set of all possible anchor IDs we're looking for
-    all_anchor_ids = set()
-    for key in id_registry.keys():
-        all_anchor_ids.add(key)
-        # Also add just the anchor part after #
-        if '#' in key:
-            all_anchor_ids.add(key.split('#', 1)[1])
-    
-    for value in id_registry.values():
-        all_anchor_ids.add(value)
-    
-    for value in file_to_prefix.values():
-        all_anchor_ids.add(value)
-    
-    # Search through each page
-    found_count = 0
-    for page_num in range(total_pages):
-        try:
-            page = reader.pages[page_num]
-            
-            # Extract text content
-            text = page.extract_text() if hasattr(page, 'extract_text') else ""
-            
-            # Also check annotations and links
-            if '/Annots' in page:
-                annotations = page['/Annots']
-                if annotations:
-                    for annot in annotations:
-                        annot_obj = annot.get_object()
-                        # Check for named destinations or anchors
-                        if '/Dest' in annot_obj:
-                            dest = str(annot_obj['/Dest'])
-                            for anchor_id in all_anchor_ids:
-                                if anchor_id in dest:
-                                    if anchor_id not in anchor_to_page:
-                                        anchor_to_page[anchor_id] = page_num
-                                        found_count += 1
-            
-            # Search for anchor IDs in the text content
-            # WeasyPrint may embed IDs as part of the rendered content
-            for anchor_id in all_anchor_ids:
-                if anchor_id in text and anchor_id not in anchor_to_page:
-                    anchor_to_page[anchor_id] = page_num
-                    found_count += 1
-            
-        except Exception as e:
-            logger.debug(f"Error scanning page {page_num}: {e}")
-            continue
+    target_id = None
     
-    logger.info(f"Mapped {found_count} anchors to pages (out of {len(all_anchor_ids)} total)")
+    if '#' in href:
+        file_part, anchor_part = href.split('#', 1)
+        
+        # Try to resolve using the ID registry
+        lookup_keys = [
+            (file_part, anchor_part),  # Full path with anchor
+            ('', anchor_part),  # Just the anchor
+        ]
+        
+        # Add basename variant
+        if file_part:
+            basename = os.path.basename(file_part)
+            lookup_keys.append((basename, anchor_part))
+        
+        # Find the prefixed ID in registry
+        for key in lookup_keys:
+            if key in id_registry:
+                target_id = id_registry[key]
+                break
+        
+        # If not found in registry, try file_to_prefix for file-only
+        if not target_id and file_part:
+            for key in [file_part, os.path.basename(file_part)]:
+                if key in file_to_prefix:
+                    target_id = file_to_prefix[key]
+                    break
+            
+    elif href.endswith(('.html', '.xhtml', '.htm')):
+        # File-only reference (no anchor)
+        lookup_keys = [href, os.path.basename(href)]
+        for key in lookup_keys:
+            if key in file_to_prefix:
+                target_id = file_to_prefix[key]
+                break
     
-    return anchor_to_page
+    return target_id or None
 
-def add_bookmarks_to_pdf(pdf_path, toc_entries, id_registry, file_to_prefix):
+def assign_bookmark_markers(toc_entries, id_registry, file_to_prefix):
     """
-    Add hierarchical bookmarks to an existing PDF file with accurate page numbers.
+    Resolve every TOC entry to its target and give it a marker id of its own.
+    
+    An element carries a single bookmark, so entries sharing a target (e.g.
+    a part and its first chapter) can't all be attached to it. Instead Pass 2
+    inserts one empty marker element per entry just before its target, in TOC
+    order, and the bookmark rules are keyed on the markers.
     
     Args:
-        pdf_path: Path to the PDF file
         toc_entries: List of (level, title, href) tuples from extract_toc_with_hierarchy
         id_registry: Global ID registry mapping
         file_to_prefix: File to prefix mapping
-    """
-    try:
-        from pypdf import PdfReader, PdfWriter
-    except ImportError:
-        try:
-            from PyPDF2 import PdfReader, PdfWriter
-        except ImportError:
-            logger.error("pypdf or PyPDF2 not installed. Cannot add bookmarks.")
-            return
     
-    import os
+    Returns:
+        - bookmarks: [(marker_id, level, title)] in TOC order
+        - markers_by_target: {target_id: [marker_id, ...]}
+    """
+    bookmarks = []
+    markers_by_target = {}
+    bookmarks_skipped = 0
     
-    logger.info(f"Adding bookmarks to PDF: {len(toc_entries)} entries")
+    for level, title, href in toc_entries:
+        target_id = resolve_toc_target(href or '', id_registry, file_to_prefix)
+        
+        if not target_id:
+            logger.debug(f"Skipping bookmark: {'  ' * level}{title} -> {href}")
+            bookmarks_skipped += 1
+            continue
+        
+        # Chapter ids are built from [A-Za-z0-9_] only, so a '-' can't clash
+        marker_id = f"toc-{len(bookmarks) + 1}"
+        bookmarks.append((marker_id, level, title))
+        markers_by_target.setdefault(target_id, []).append(marker_id)
     
-    # First, build a map of anchor IDs to page numbers
-    anchor_to_page = build_anchor_to_page_map(pdf_path, id_registry, file_to_prefix)
+    if bookmarks_skipped > 0:
+        logger.warning(f"  Skipped {bookmarks_skipped} bookmarks with unresolved targets")
     
-    # Read the existing PDF
-    reader = PdfReader(pdf_path)
-    writer = PdfWriter()
+    return bookmarks, markers_by_target
+
+def build_bookmark_css(bookmarks, placed_markers):
+    """
+    Build CSS that makes WeasyPrint emit the EPUB TOC as the PDF outline.
     
-    # Copy all pages
-    for page in reader.pages:
-        writer.add_page(page)
+    Each marker Pass 2 actually placed gets bookmark-level/bookmark-label
+    rules, and the default heading bookmarks are switched off so the outline
+    mirrors the TOC. If no marker was placed the heading bookmarks are kept.
+    Page numbers come straight from WeasyPrint's layout.
     
-    # Build bookmark hierarchy
-    # Stack to track parent bookmarks: [(level, bookmark_object), ...]
-    parent_stack = []
-    bookmarks_added = 0
-    bookmarks_skipped = 0
+    Args:
+        bookmarks: [(marker_id, level, title)] from assign_bookmark_markers
+        placed_markers: Set of marker ids inserted into the master document
+    """
+    rules = [
+        f"#{_css_ident(marker_id)} {{ bookmark-level: {level + 1}; "
+        f"bookmark-label: {_css_string(title)}; }}"
+        for marker_id, level, title in bookmarks
+        if marker_id in placed_markers
+    ]
     
-    for level, title, href in toc_entries:
-        try:
-            # Parse the href to get the target ID
-            target_id = None
-            page_num = 0  # Default to first page
-            
-            if '#' in href:
-                file_part, anchor_part = href.split('#', 1)
-                
-                # Try to resolve using the ID registry
-                lookup_keys = [
-                    href,  # Full href as-is
-                    f"{file_part}#{anchor_part}",
-                    anchor_part,  # Just the anchor
-                ]
-                
-                # Add basename variant
-                if file_part:
-                    basename = os.path.basename(file_part)
-                    lookup_keys.append(f"{basename}#{anchor_part}")
-                
-                # Find the prefixed ID in registry
-                for key in lookup_keys:
-                    if key in id_registry:
-                        target_id = id_registry[key]
-                        break
-                
-                # If not found in registry, try file_to_prefix for file-only
-                if not target_id and file_part:
-                    for key in [file_part, os.path.basename(file_part)]:
-                        if key in file_to_prefix:
-                            target_id = file_to_prefix[key]
-                            break
-                
-                # Last resort: use the anchor directly
-                if not target_id:
-                    target_id = anchor_part
-                    
-            elif href.endswith(('.html', '.xhtml', '.htm')):
-                # File-only reference (no anchor)
-                lookup_keys = [href, os.path.basename(href)]
-                for key in lookup_keys:
-                    if key in file_to_prefix:
-                        target_id = file_to_prefix[key]
-                        break
-            
-            # Look up the page number for this target ID
-            if target_id:
-                # Try various forms of the target ID
-                search_keys = [
-                    target_id,
-                    target_id.lower(),
-                    target_id.replace('_', '-'),
-                ]
-                
-                for key in search_keys:
-                    if key in anchor_to_page:
-                        page_num = anchor_to_page[key]
-                        break
-            
-            # Adjust the parent stack to the current level
-            while len(parent_stack) > 0 and parent_stack[-1][0] >= level:
-                parent_stack.pop()
-            
-            # Determine the parent bookmark
-            parent = parent_stack[-1][1] if parent_stack else None
-            
-            # Add the bookmark
-            new_bookmark = writer.add_outline_item(
-                title=title,
-                page_number=page_num,
-                parent=parent
-            )
-            
-            # Add to stack for potential children
-            parent_stack.append((level, new_bookmark))
-            
-            bookmarks_added += 1
-            logger.debug(f"Added bookmark: {'  ' * level}{title} -> page {page_num + 1}")
-            
-        except Exception as e:
-            logger.warning(f"Error adding bookmark '{title}': {e}")
-            bookmarks_skipped += 1
-            continue
+    missing = len(bookmarks) - len(rules)
+    if missing > 0:
+        logger.warning(f"  Skipped {missing} bookmarks whose targets are missing from their chapters")
     
-    # Write the PDF with bookmarks
-    temp_path = pdf_path + ".tmp"
-    with open(temp_path, 'wb') as output_file:
-        writer.write(output_file)
+    if not rules:
+        logger.warning("No TOC entry could be placed, using heading bookmarks")
+        return ""
     
-    # Replace the original file
-    import shutil
-    shutil.move(temp_path, pdf_path)
+    logger.info(f"Prepared {len(rules)} bookmarks from the TOC")
+    rules.insert(0, "h1, h2, h3, h4, h5, h6 { bookmark-level: none; }")
+    return '\n'.join(rules)
+
+def _scan_ids(content_bytes):
+    """
+    Yield (id, is_body) for the id attribute of every start tag in raw
+    chapter bytes; is_body marks the id of the <body> element itself.
+    """
+    if not _HAS_ID_ATTR(content_bytes):
+        return
     
-    logger.info(f"✓ Successfully added {bookmarks_added} bookmarks to PDF")
-    if bookmarks_skipped > 0:
-        logger.warning(f"  Skipped {bookmarks_skipped} bookmarks due to errors")
+    for tag in _START_TAG_RE.finditer(content_bytes):
+        tag_bytes = tag.group(1) or tag.group(3)
+        if tag_bytes is None:
+            continue  # Comment
+        
+        is_body = _BODY_TAG_RE(tag_bytes) is not None
+        # Like lxml, only the first of duplicate id attributes counts
+        for match in _ATTR_RE.finditer(tag_bytes, _TAG_NAME_RE.match(tag_bytes).end()):
+            if match.group(1).lower() == b'id':
+                value = match.group(2) or match.group(3) or match.group(4) or b''
+                yield html.unescape(value.decode('utf-8', errors='replace')), is_body
+                break
 
-def build_global_id_registry(book, spine_items, base_root):
+def _chapter_prefix(file_name):
+    """Derive a chapter's id prefix from its EPUB-relative file path."""
+    return _PREFIX_UNSAFE_RE.sub('_', os.path.splitext(file_name)[0])
+
+def build_global_id_registry(chapter_items, base_root):
     """
     Pass 1: Scan all chapters and build a mapping of original IDs to prefixed IDs.
     Returns:
-        - id_registry: {original_id: prefixed_id, "file.xhtml#id": prefixed_id}
+        - id_registry: {("", original_id): prefixed_id, ("file.xhtml", id): prefixed_id}
         - file_to_prefix: {file_path: chapter_prefix}
+    
+    Registry keys are (file, id) tuples, registered under the full path, the
+    basename and "" (any file). File names and prefixes are interned since
+    each is shared by every ID in its chapter.
     """
     id_registry = {}
     file_to_prefix = {}
+    used_prefixes = set()
     
     logger.info("Building global ID registry (Pass 1)...")
     
-    for item_id, _ in spine_items:
+    for item in chapter_items:
         try:
-            item = book.get_item_with_id(item_id)
-            
-            if not item or not is_html_content(item):
-                continue
-            
-            # Get content
+            # Get raw content; IDs are scanned straight from the bytes
             try:
-                content = item.get_content().decode('utf-8', errors='ignore')
+                content_bytes = item.get_content()
             except:
-                content = item.content.decode('utf-8', errors='ignore')
+                content_bytes = item.content
             
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Generate unique chapter prefix from full file path to avoid collisions
-            chapter_prefix = item.file_name.replace('/', '_').replace('\\', '_')
-            chapter_prefix = os.path.splitext(chapter_prefix)[0]
+            # Generate unique chapter prefix from full file path to avoid
+            # collisions; paths that sanitize to the same prefix get a suffix
+            file_name = sys.intern(item.file_name)
+            chapter_prefix = base_prefix = _chapter_prefix(file_name)
+            suffix = 2
+            while chapter_prefix in used_prefixes:
+                chapter_prefix = f"{base_prefix}_{suffix}"
+                suffix += 1
+            chapter_prefix = sys.intern(chapter_prefix)
+            used_prefixes.add(chapter_prefix)
+            basename = sys.intern(os.path.basename(file_name))
             
             # Store the mapping from file path to prefix
-            file_to_prefix[item.file_name] = chapter_prefix
+            file_to_prefix[file_name] = chapter_prefix
             
             # Register all IDs in this chapter
-            for element in soup.find_all(id=True):
-                original_id = element['id']
-                prefixed_id = f"{chapter_prefix}_{original_id}"
+            for original_id, is_body in _scan_ids(content_bytes):
+                prefixed_id = chapter_prefix if is_body else f"{chapter_prefix}_{original_id}"
                 
-                # Store both formats for lookup flexibility
-                id_registry[original_id] = prefixed_id  # For same-file refs
-                id_registry[f"{item.file_name}#{original_id}"] = prefixed_id  # For cross-file refs
+                # Store all formats for lookup flexibility
+                id_registry['', original_id] = prefixed_id  # For same-file refs
+                id_registry[file_name, original_id] = prefixed_id  # For cross-file refs
                 
                 # Also handle just the basename for cross-file refs
-                basename = os.path.basename(item.file_name)
-                id_registry[f"{basename}#{original_id}"] = prefixed_id
+                id_registry[basename, original_id] = prefixed_id
             
             logger.debug(f"Registered IDs from: {item.file_name} (prefix: {chapter_prefix})")
             
         except Exception as e:
-            logger.warning(f"Error scanning {item_id} for registry: {e}")
+            logger.warning(f"Error scanning {item.id} for registry: {e}")
             continue
     
     logger.info(f"Registry complete: {len(id_registry)} ID mappings, {len(file_to_prefix)} files")
     return id_registry, file_to_prefix
 
 
-def fix_internal_links_with_registry(soup, current_file_path, current_prefix, id_registry, file_to_prefix):
+def fix_internal_links_with_registry(links, current_file_path, current_prefix, id_registry, file_to_prefix, known_files):
     """
     Pass 2: Update links using the global ID registry.
     
     Args:
-        soup: BeautifulSoup object of current chapter
+        links: The chapter's <a> elements that carry an href
         current_file_path: Full file path of current chapter (e.g., "OEBPS/text/ch01.xhtml")
         current_prefix: Chapter prefix for this file (e.g., "OEBPS_text_ch01")
         id_registry: Global mapping of IDs
         file_to_prefix: Mapping of file paths to their prefixes
+        known_files: Basenames of every file in file_to_prefix
     """
-    for a in soup.find_all('a', href=True):
-        href = a['href']
+    current_dir = os.path.dirname(current_file_path)
+    
+    # Chapters link to the same targets many times; resolve each distinct
+    # href once. Maps raw href -> rewritten href (None if unresolved).
+    local_cache = {}
+    
+    for a in links:
+        href = a.get('href')
+        
+        if href in local_cache:
+            new_href = local_cache[href]
+            if new_href:
+                a.set('href', new_href)
+            continue
         
         # Skip external links
-        if href.startswith(('http://', 'https://', 'mailto:', 'tel:')):
+        if _EXTERNAL_HREF(href):
             continue
         
         # Handle page number references (remove functionality)
         if '#page_' in href:
             anchor_id = href.split('#')[1] if '#' in href else None
             if anchor_id and anchor_id.startswith('page_'):
-                a.unwrap()
+                a.drop_tag()
                 continue
         
+        new_href = None
+        
         # Parse href
         if '#' in href:
             file_part, anchor_part = href.split('#', 1)
             
             if file_part:
                 # Cross-file reference
-                # Try different lookup formats
-                lookup_keys = [
-                    f"{file_part}#{anchor_part}",  # Full path with anchor
-                    f"{os.path.basename(file_part)}#{anchor_part}",  # Basename with anchor
-                ]
+                # Every lookup format shares the target's basename, so a
+                # file outside the spine can't resolve - skip the probes
+                target_name = _path_basename(file_part)
+                if target_name not in known_files:
+                    logger.warning(f"Broken cross-file link in {current_file_path}: {href} (file not in spine)")
+                    local_cache[href] = None
+                    continue
                 
-                # Try to resolve the target directory relative to current file
-                if not file_part.startswith('/'):
-                    current_dir = os.path.dirname(current_file_path)
-                    resolved_path = os.path.normpath(os.path.join(current_dir, file_part))
-                    lookup_keys.append(f"{resolved_path}#{anchor_part}")
+                # Try lookup formats from most to least likely, only
+                # building the next key when the previous one misses
+                lookup_keys = [file_part]  # Full path with anchor
+                hit = id_registry.get((file_part, anchor_part))
+                if hit is None:
+                    lookup_keys.append(target_name)  # Basename with anchor
+                    hit = id_registry.get((lookup_keys[-1], anchor_part))
+                    # Try to resolve the target directory relative to current file
+                    if hit is None and not file_part.startswith('/'):
+                        lookup_keys.append(_norm_join(current_dir, file_part))
+                        hit = id_registry.get((lookup_keys[-1], anchor_part))
                 
-                found = False
-                for key in lookup_keys:
-                    if key in id_registry:
-                        a['href'] = f"#{id_registry[key]}"
-                        found = True
-                        break
-                
-                if not found:
-                    logger.warning(f"Broken cross-file link in {current_file_path}: {href} (tried: {lookup_keys})")
+                if hit:
+                    new_href = f"#{hit}"
+                else:
+                    logger.warning(f"Broken cross-file link in {current_file_path}: {href} (tried: {[key + '#' + anchor_part for key in lookup_keys]})")
             else:
                 # Same-file reference
                 prefixed_anchor = f"{current_prefix}_{anchor_part}"
-                if anchor_part in id_registry:
-                    # If the anchor is registered globally, use its prefixed version
-                    a['href'] = f"#{id_registry[anchor_part]}"
+                # Prefer this chapter's own id (the one process_chapter_dom
+                # renamed) over whichever chapter registered it globally last
+                hit = id_registry.get((current_file_path, anchor_part))
+                if hit is None:
+                    hit = id_registry.get(('', anchor_part))
+                if hit:
+                    # If the anchor is registered, use its prefixed version
+                    new_href = f"#{hit}"
                 else:
                     # Fallback: use current file's prefix
-                    a['href'] = f"#{prefixed_anchor}"
-                    logger.debug(f"Same-file link fallback: {href} -> {a['href']}")
+                    new_href = f"#{prefixed_anchor}"
+                    logger.debug(f"Same-file link fallback: {href} -> {new_href}")
                     
         elif href.endswith(('.html', '.xhtml', '.htm')):
             # Link to a file without anchor - link to the chapter section
             # Try to find the target file's prefix
-            lookup_keys = [href, os.path.basename(href)]
+            hit = None
+            target_name = _path_basename(href)
+            if target_name in known_files:
+                hit = file_to_prefix.get(href)
+                if hit is None:
+                    hit = file_to_prefix.get(target_name)
+                    if hit is None and not href.startswith('/'):
+                        hit = file_to_prefix.get(_norm_join(current_dir, href))
             
-            if not href.startswith('/'):
-                current_dir = os.path.dirname(current_file_path)
-                resolved_path = os.path.normpath(os.path.join(current_dir, href))
-                lookup_keys.append(resolved_path)
-            
-            found = False
-            for key in lookup_keys:
-                if key in file_to_prefix:
-                    a['href'] = f"#{file_to_prefix[key]}"
-                    found = True
-                    break
-            
-            if not found:
+            if hit:
+                new_href = f"#{hit}"
+            else:
                 logger.warning(f"Broken file link in {current_file_path}: {href}")
+        
+        local_cache[href] = new_href
+        if new_href:
+            a.set('href', new_href)
 
-def extract_body_content(soup):
+def extract_body_content(tree):
     """
-    Extract just the body content, stripping out <html>, <head>, <body> tags.
-    Returns the inner HTML of the body.
+    Extract just the body element, leaving <html> and <head> behind.
     """
-    body = soup.find('body')
-    if body:
+    body = tree.find('body')
+    if body is not None:
         return body
-    # If no body tag, return the whole soup
-    return soup
+    # If no body tag, return the whole tree
+    return tree
+
+@lru_cache(maxsize=None)
+def _chapter_nodes_xpath(ids, links, images):
+    """
+    Compiled query for the subset of Pass 2 nodes a chapter can contain,
+    or None if it can contain none of them.
+    """
+    parts = [
+        part for part, wanted in (
+            ('.//*[@id]', ids),
+            ('.//a[@href]', links),
+            ('.//img[@src]', images),
+        ) if wanted
+    ]
+    return etree.XPath(' | '.join(parts)) if parts else None
+
+def _insert_bookmark_markers(element, marker_ids):
+    """Insert an empty marker <span> for each TOC entry just before element."""
+    for marker_id in marker_ids:
+        element.addprevious(element.makeelement('span', id=marker_id))
+
+def process_chapter_dom(body, current_file_path, chapter_prefix, base_root, id_registry, file_to_prefix, known_files, file_index, select_nodes=_CHAPTER_NODES_XPATH, markers_by_target=None):
+    """
+    Rewrite a chapter's DOM from a single XPath query.
+    
+    IDs are renamed to their registry-assigned prefixed form in place, to
+    prevent duplicates across chapters, while <a href> and <img> elements
+    are collected. The collected links and images are then fixed from those
+    lists, so the tree is not traversed again. select_nodes may be a
+    narrower query from _chapter_nodes_xpath, or None to skip the walk.
+    
+    Bookmark markers from markers_by_target are inserted before the first
+    element carrying each target id. Returns the marker ids placed.
+    """
+    links = []
+    images = []
+    placed = []
+    
+    for element in (select_nodes(body) if select_nodes is not None else ()):
+        old_id = element.get('id')
+        if old_id is not None:
+            new_id = id_registry.get((current_file_path, old_id), f"{chapter_prefix}_{old_id}")
+            element.set('id', new_id)
+            if markers_by_target and new_id in markers_by_target:
+                # Duplicate ids only keep their first element as the target
+                marker_ids = markers_by_target.pop(new_id)
+                _insert_bookmark_markers(element, marker_ids)
+                placed.extend(marker_ids)
+        
+        tag = element.tag
+        if tag == 'a':
+            if element.get('href') is not None:
+                links.append(element)
+        elif tag == 'img' and element.get('src') is not None:
+            images.append(element)
+    
+    # Fix internal links using global registry (this also remaps same-file
+    # "#id" references to the renamed IDs)
+    if links:
+        fix_internal_links_with_registry(links, current_file_path, chapter_prefix, id_registry, file_to_prefix, known_files)
+    
+    # Fix image paths - need to pass the HTML file's path for relative resolution
+    if images:
+        html_file_path = os.path.join(base_root, current_file_path)
+        fix_image_paths(images, base_root, html_file_path, file_index)
+    
+    return placed
+
+# <body> attributes carried over to the chapter <section>
+_KEPT_BODY_ATTRS = ('lang', 'xml:lang', 'dir', 'style')
+
+# Read-only state shared by every chapter in a worker process, installed
+# once per process by _init_chapter_worker instead of pickled per task
+_worker_state = {}
+
+def _init_chapter_worker(base_root, id_registry, file_to_prefix, file_index, markers_by_target):
+    """ProcessPoolExecutor initializer for Pass 2 workers."""
+    _worker_state['base_root'] = base_root
+    _worker_state['id_registry'] = id_registry
+    _worker_state['file_to_prefix'] = file_to_prefix
+    # Derived here rather than pickled alongside the registry
+    _worker_state['known_files'] = frozenset(os.path.basename(f) for f in file_to_prefix)
+    _worker_state['file_index'] = file_index
+    _worker_state['markers_by_target'] = markers_by_target
+
+def _process_chapter(job):
+    """
+    Pass 2 for a single chapter: parse it, rename IDs, fix links and images,
+    and return the chapter wrapped in its navigation <section> as UTF-8
+    bytes along with the bookmark marker ids placed in it. job is
+    (item_id, file_name, content_bytes); returns None on failure.
+    """
+    item_id, file_name, content_bytes = job
+    base_root = _worker_state['base_root']
+    id_registry = _worker_state['id_registry']
+    file_to_prefix = _worker_state['file_to_prefix']
+    known_files = _worker_state['known_files']
+    file_index = _worker_state['file_index']
+    
+    try:
+        tree = _parse(content_bytes)
+        
+        body = extract_body_content(tree)
+        
+        # Get the chapter prefix from registry (using full path for uniqueness)
+        chapter_prefix = file_to_prefix.get(file_name)
+        
+        if not chapter_prefix:
+            # Fallback if not in registry
+            chapter_prefix = _chapter_prefix(file_name)
+            logger.warning(f"Chapter {file_name} not in registry, using fallback prefix")
+        
+        # Only query for the kinds of nodes the raw chapter can contain
+        select_nodes = _chapter_nodes_xpath(
+            _HAS_ID_ATTR(content_bytes) is not None,
+            _HAS_HREF_ATTR(content_bytes) is not None,
+            _HAS_IMG_TAG(content_bytes) is not None,
+        )
+        
+        # Each chapter gets its own copy, so the first element with a target
+        # id takes that target's markers
+        markers_by_target = dict(_worker_state['markers_by_target'])
+        
+        # Deduplicate IDs, fix links and fix image paths in one traversal
+        placed = process_chapter_dom(body, file_name, chapter_prefix, base_root, id_registry, file_to_prefix, known_files, file_index, select_nodes, markers_by_target)
+        
+        # Turn the body itself into a section with ID for navigation
+        # (use chapter_prefix for consistency; Pass 1 registered the body's
+        # own id as an alias of it) and serialize it in C. The body's
+        # class, language and inline style still apply to the section.
+        kept_attrs = {name: body.get(name) for name in _KEPT_BODY_ATTRS if body.get(name) is not None}
+        body_class = body.get('class', '').strip()
+        body.tag = 'section'
+        body.attrib.clear()
+        body.set('id', chapter_prefix)
+        body.set('class', f"chapter {body_class}" if body_class else 'chapter')
+        for name, value in kept_attrs.items():
+            body.set(name, value)
+        
+        # Entries targeting the chapter itself are marked at its very start
+        chapter_markers = markers_by_target.get(chapter_prefix)
+        if chapter_markers:
+            for index, marker_id in enumerate(chapter_markers):
+                body.insert(index, body.makeelement('span', id=marker_id))
+            body[len(chapter_markers) - 1].tail, body.text = body.text, None
+            placed.extend(chapter_markers)
+        
+        # UTF-8 bytes go straight into the master buffer without re-encoding
+        return lhtml.tostring(body, encoding='utf-8', method='html', with_tail=False), placed
+        
+    except Exception as e:
+        logger.error(f"Error processing {item_id}: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
 
-def process_epub(input_path, output_path, temp_dir):
+def process_epub(input_path, output_path, temp_dir, base_root):
     """
     Main conversion function using single-document approach.
+    temp_dir is the extraction directory and base_root the directory
+    holding the .opf file, as returned by utils.extract_epub.
     """
     logger.info(f"Loading EPUB: {input_path}")
     book = epub.read_epub(input_path)
     
-    # Find the base directory for assets
-    base_root = temp_dir
-    for root, dirs, files in os.walk(temp_dir):
-        for file in files:
-            if file.endswith('.opf'):
-                base_root = root
-                logger.info(f"Found OPF base: {base_root}")
-                break
+    # Index manifest items once so spine lookups don't rescan book.items
+    items_by_id = {item.id: item for item in book.get_items()}
+    
+    # Index every extracted file once; relative asset paths may climb
+    # above the OPF directory, so index the whole extraction
+    file_index = build_file_index(temp_dir)
+    logger.info(f"Indexed {len(file_index)} extracted files")
     
     # Collect all CSS
     logger.info("Collecting CSS stylesheets...")
-    all_css = collect_css_files(book, base_root)
+    epub_css = collect_css_files(book, base_root, file_index)
     
     # Process spine to build master HTML
     spine_items = list(book.spine)
     logger.info(f"Found {len(spine_items)} spine items")
     
-    chapter_htmls = []
+    # Resolve and classify the spine once; both passes only visit these
+    chapter_items = []
+    for item_id, _ in spine_items:
+        item = items_by_id.get(item_id)
+        if item and is_html_content(item):
+            chapter_items.append(item)
+    
     processed_count = 0
 
     # Build global ID registry BEFORE processing chapters
     logger.info("Pass 1: Building global ID registry...")
-    id_registry, file_to_prefix = build_global_id_registry(book, spine_items, base_root)
+    id_registry, file_to_prefix = build_global_id_registry(chapter_items, base_root)
     logger.info(f"Registry complete: {len(file_to_prefix)} files indexed")
 
-    # Extract TOC structure for bookmarks
+    # Extract TOC structure for bookmarks; Pass 2 places a marker for each
+    # entry and WeasyPrint builds the PDF outline from them during rendering
     logger.info("Extracting table of contents...")
     toc_entries = extract_toc_with_hierarchy(book)
+    if toc_entries:
+        bookmarks, markers_by_target = assign_bookmark_markers(toc_entries, id_registry, file_to_prefix)
+    else:
+        logger.warning("No TOC found in EPUB, using heading bookmarks")
+        bookmarks, markers_by_target = [], {}
+    placed_markers = set()
 
     
-    logger.info("Processing chapters...")
-    for i, (item_id, _) in enumerate(tqdm(spine_items, desc="Building master document")):
-        try:
-            item = book.get_item_with_id(item_id)
-            
-            if not item or not is_html_content(item):
-                continue
-            
-            # Get content
-            try:
-                content = item.get_content().decode('utf-8', errors='ignore')
-            except:
-                content = item.content.decode('utf-8', errors='ignore')
-            
-            # Parse HTML
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Get the chapter prefix from registry (using full path for uniqueness)
-            chapter_prefix = file_to_prefix.get(item.file_name)
-            
-            if not chapter_prefix:
-                # Fallback if not in registry
-                chapter_prefix = item.file_name.replace('/', '_').replace('\\', '_')
-                chapter_prefix = os.path.splitext(chapter_prefix)[0]
-                logger.warning(f"Chapter {item.file_name} not in registry, using fallback prefix")
-            
-            # Fix internal links using global registry
-            fix_internal_links_with_registry(soup, item.file_name, chapter_prefix, id_registry, file_to_prefix)
-            
-            # Deduplicate IDs
-            deduplicate_ids(soup, chapter_prefix)
-            
-            # Fix image paths - need to pass the HTML file's path for relative resolution
-            html_file_path = os.path.join(base_root, item.file_name)
-            fix_image_paths(soup, base_root, html_file_path)
-
-            # Extract body content
-            body_content = extract_body_content(soup)
-            
-            # Wrap in a section with ID for navigation (use chapter_prefix for consistency)
-            section_wrapper = f'<section id="{chapter_prefix}" class="chapter">\n{body_content}\n</section>'
-            
-            chapter_htmls.append(section_wrapper)
-            processed_count += 1
-            
-        except Exception as e:
-            logger.error(f"Error processing {item_id}: {e}")
-            import traceback
-            traceback.print_exc()
-            continue
-    
-    logger.info(f"Successfully processed {processed_count}/{len(spine_items)} items")
+    # Link each filtered EPUB stylesheet from the master <head> so it stays
+    # in the author origin, as it was when inlined. Each is written next to
+    # its original, so any remaining relative url() resolves as before, and
+    # WeasyPrint parses it once from the file.
+    stylesheet_links = []
+    for file_name, content in epub_css:
+        css_dir = os.path.normpath(os.path.dirname(os.path.join(base_root, file_name)))
+        if not css_dir.startswith(os.path.join(temp_dir, '')):
+            css_dir = temp_dir
+        os.makedirs(css_dir, exist_ok=True)
+        css_fd, css_path = tempfile.mkstemp(suffix='.css', dir=css_dir)
+        with os.fdopen(css_fd, 'w', encoding='utf-8') as css_file:
+            css_file.write(content)
+        stylesheet_links.append(f'    <link rel="stylesheet" href="{html.escape(f"file://{css_path}")}">\n')
+    del epub_css
     
-    if processed_count == 0:
-        raise Exception("No content was successfully processed!")
+    # The bookmark rules are only known once Pass 2 has placed the markers,
+    # so reserve their stylesheet now and fill it in afterwards
+    bookmark_fd, bookmark_css_path = tempfile.mkstemp(suffix='.css', dir=temp_dir)
+    os.close(bookmark_fd)
     
-    # Build master HTML document
-    logger.info("Building master HTML document...")
-    
-    master_html = f"""
+    # Build master HTML document; the PDF rules follow the EPUB CSS
+    template_head = f"""
 <!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
     <title>Converted EPUB</title>
-    <style>
-        /* Original EPUB CSS */
-        {all_css}
-        
-        /* PDF-specific pagination rules */
-        @page {{
-            size: A4;
-            margin: 2cm;
-        }}
-        
-        /* Ensure sections start on new page if desired */
-        section.chapter {{
-            page-break-before: auto;
-        }}
-        
-        /* Image handling */
-        img {{
-            max-width: 100%;
-            height: auto;
-            page-break-inside: avoid;
-        }}
-        
-        /* Prevent awkward breaks */
-        h1, h2, h3, h4, h5, h6 {{
-            page-break-after: avoid;
-        }}
-        
-        /* Ensure links are colored and underlined */
-        a {{
-            color: #0066cc;
-            text-decoration: underline;
-        }}
-    </style>
+{''.join(stylesheet_links)}    <style>{_PDF_CSS}    </style>
+    <link rel="stylesheet" href="{html.escape(f"file://{bookmark_css_path}")}">
 </head>
 <body>
-    {''.join(chapter_htmls)}
+    """
+    template_tail = """
 </body>
 </html>
 """
     
+    logger.info("Processing chapters...")
+    
+    # Chapters are independent once the registry exists, so rewrite them
+    # in parallel processes; executor.map yields results in spine order
+    jobs = []
+    for item in chapter_items:
+        try:
+            content_bytes = item.get_content()
+        except:
+            content_bytes = item.content
+        jobs.append((item.id, item.file_name, content_bytes))
+    
+    # Stream the master document to disk as chapters come back, so no
+    # chapter outlives its write and WeasyPrint reads it from the file
+    master_fd, master_path = tempfile.mkstemp(suffix='.html', dir=temp_dir)
+    with os.fdopen(master_fd, 'wb') as master_file, ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        initializer=_init_chapter_worker,
+        initargs=(base_root, id_registry, file_to_prefix, file_index, markers_by_target),
+    ) as executor:
+        master_file.write(template_head.encode('utf-8'))
+        results = executor.map(_process_chapter, jobs, chunksize=4)
+        for result in tqdm(results, total=len(jobs), desc="Building master document"):
+            if result is not None:
+                section_html, placed = result
+                master_file.write(section_html)
+                placed_markers.update(placed)
+                processed_count += 1
+        master_file.write(template_tail.encode('utf-8'))
+    
+    logger.info(f"Successfully processed {processed_count}/{len(spine_items)} items")
+    
+    if processed_count == 0:
+        raise Exception("No content was successfully processed!")
+    
+    bookmark_css = build_bookmark_css(bookmarks, placed_markers) if toc_entries else ""
+    with open(bookmark_css_path, 'w', encoding='utf-8') as bookmark_file:
+        bookmark_file.write(bookmark_css)
+    
     # Render to PDF
     logger.info("Rendering PDF (this may take several minutes for large files)...")
     
     try:
         # Use base_url to help resolve any remaining relative references
-        HTML(string=master_html, base_url=f"file://{base_root}/").write_pdf(
+        HTML(filename=master_path, encoding='utf-8', base_url=f"file://{base_root}/").write_pdf(
             output_path,
-            stylesheets=None,  # CSS is already inlined
+            stylesheets=None,  # CSS is linked from the master document
         )
         
         final_size = os.path.getsize(output_path)
         logger.info(f"✓ PDF created successfully: {final_size:,} bytes ({final_size/1024/1024:.1f} MB)")
-
-        # Add bookmarks to the PDF
-        if toc_entries:
-            logger.info("Adding table of contents bookmarks...")
-            add_bookmarks_to_pdf(output_path, toc_entries, id_registry, file_to_prefix)
-        else:
-            logger.warning("No TOC found in EPUB, skipping bookmark creation")
         
     except Exception as e:
         logger.error(f"Error rendering PDF: {e}")
         import traceback
         traceback.print_exc()
         raise
-
-def deduplicate_ids(soup, chapter_prefix):
-    """
-    Add a prefix to all IDs and update href references to prevent duplicates.
-    """
-    id_map = {}
-    
-    # First pass: rename all IDs
-    for element in soup.find_all(id=True):
-        old_id = element['id']
-        new_id = f"{chapter_prefix}_{old_id}"
-        element['id'] = new_id
-        id_map[old_id] = new_id
-    
-    # Second pass: update all internal href references
-    for a in soup.find_all('a', href=True):
-        href = a['href']
-        if href.startswith('#'):
-            old_id = href[1:]
-            if old_id in id_map:
-                a['href'] = f"#{id_map[old_id]}"
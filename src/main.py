@@ -28,10 +28,10 @@ def main(input_path, output):
     
     try:
         print("Extracting EPUB assets...")
-        extract_epub(str(input_path), temp_dir)
+        base_root = extract_epub(str(input_path), temp_dir)
         
         print("Converting to PDF...")
-        process_epub(str(input_path), str(output), temp_dir)
+        process_epub(str(input_path), str(output), temp_dir, base_root)
         
         print(f"\n✓ Conversion complete: {output}")
         
@@ -1,16 +1,61 @@
 import os
+import logging
 import zipfile
 import shutil
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+# Audio and video can't appear in a PDF and are usually the bulk of a
+# media-rich EPUB, so they are left in the archive. Everything else is
+# extracted, since assets may use any suffix (or none at all).
+_SKIPPED_MEDIA_SUFFIXES = (
+    '.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.wav', '.flac',
+    '.mp4', '.m4v', '.webm', '.ogv', '.mov', '.avi', '.mkv', '.mpg', '.mpeg',
+)
 
 def extract_epub(epub_path, extract_dir):
-    """Unzips the EPUB to a temporary directory."""
+    """
+    Unzips the EPUB, minus audio and video, to a temporary directory.
+    Returns the directory holding the package (.opf) file, located from the
+    archive itself so the extracted tree never has to be searched.
+    """
     if not os.path.exists(extract_dir):
         os.makedirs(extract_dir)
     
     with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
+        for info in zip_ref.infolist():
+            if not info.filename.lower().endswith(_SKIPPED_MEDIA_SUFFIXES):
+                zip_ref.extract(info, extract_dir)
+        opf_name = find_opf_name(zip_ref)
+    
+    if opf_name is None:
+        logger.warning("No OPF file found in EPUB, using extraction root")
+        return extract_dir
+    
+    base_root = os.path.dirname(os.path.normpath(os.path.join(extract_dir, opf_name)))
+    logger.info(f"Found OPF base: {base_root}")
+    return base_root
+
+def find_opf_name(zip_ref):
+    """
+    Return the archive path of the EPUB's package (.opf) file, or None.
+    Reads the rootfile path from META-INF/container.xml, falling back to
+    the archive's name list when the container is missing or unreadable.
+    """
+    try:
+        rootfile = ET.fromstring(zip_ref.read('META-INF/container.xml')).find('.//{*}rootfile')
+        full_path = rootfile.get('full-path') if rootfile is not None else None
+        if full_path:
+            return full_path
+    except (KeyError, ET.ParseError) as e:
+        logger.warning(f"Could not read container.xml: {e}")
+    
+    for name in zip_ref.namelist():
+        if name.lower().endswith('.opf'):
+            return name
     
-    return extract_dir
+    return None
 
 def cleanup_temp(extract_dir):
     """Removes the temporary directory."""